@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
 import hashlib
 import matplotlib.pyplot as plt
 import numpy as np
@@ -11,16 +12,35 @@ import subprocess
 import tempfile
 
 
+# Deleting these from an object name must leave nothing behind.
+_HEX = b"0123456789abcdef"
+
+# Git omits the insertions or deletions when there are none.
+_SHORTSTAT = re.compile(
+        rb" \d+ files? changed"
+        rb"(?:, (\d+) insertions?\(\+\))?"
+        rb"(?:, (\d+) deletions?\(-\))?")
+
+
 def cachefile_name(repository, after, before):
     cmd = ["git", "-C", repository, "rev-parse", "HEAD"]
-    head_rev = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+    head_rev = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            close_fds=False,
+            check=True)
 
+    # Separate the fields so that, say, after="a", before="bc" and
+    # after="ab", before="c" cannot share a key.
     digest = hashlib.sha256()
-    digest.update(bytes(repository, "UTF-8"))
+    digest.update(os.fsencode(repository))
+    digest.update(b"\0")
     digest.update(head_rev.stdout)
-    digest.update(bytes(str(after), "UTF-8"))
-    digest.update(bytes(str(before), "UTF-8"))
-    key = digest.hexdigest() + ".csv"
+    digest.update(b"\0")
+    digest.update(after.encode() if after else b"")
+    digest.update(b"\0")
+    digest.update(before.encode() if before else b"")
+    key = digest.hexdigest() + ".npz"
 
     return os.path.join(
             tempfile.gettempdir(),
@@ -30,15 +50,33 @@ def cachefile_name(repository, after, before):
 
 
 def git_numstat(repository, after, before, cache=True):
+    # Naming the cache file costs a git-rev-parse; don't pay for it when the
+    # cache is not wanted.
+    if not cache:
+        return uncached_git_numstat(repository, after, before)
+
+    # The key covers only what shapes the analysis. Presentation options like
+    # --max-size and --mark-hours reuse the same cache.
     cachefile = cachefile_name(repository, after, before)
 
-    if cache and os.path.exists(cachefile):
-        return pd.read_csv(cachefile, index_col=0, parse_dates=False)
+    # The cache lives in a shared temporary directory, so store plain arrays
+    # that cannot execute code when loaded, unlike a pickle. They also load
+    # without re-parsing text and keep the integer column types.
+    if os.path.exists(cachefile):
+        with np.load(cachefile, allow_pickle=False) as cached:
+            return pd.DataFrame({
+                "added": cached["added"],
+                "removed": cached["removed"],
+                "changed": cached["changed"],
+                })
     else:
         res = uncached_git_numstat(repository, after, before)
-        if cache:
-            os.makedirs(os.path.dirname(cachefile), exist_ok=True)
-            res.to_csv(cachefile)
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        np.savez(
+                cachefile,
+                added=res.added.values,
+                removed=res.removed.values,
+                changed=res.changed.values)
         return res
 
 
@@ -49,83 +87,111 @@ def uncached_git_numstat(repository, after, before):
             repository,
             "log",
             "--no-merges",
+            "--no-show-signature",
             "--format=%H",
-            "--numstat"
+            "--shortstat"
             ]
 
     if after:
-        cmd.append("--after", after)
+        cmd.extend(("--after", after))
 
     if before:
-        cmd.append("--before", before)
-
-    res = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True)
-
-    added = []
-    removed = []
-    changed = []
-    a = r = c = 0
-    # stdout format is
-    #   <commit>
-    #   <empty>
-    #   <added><blank><removed><blank><file1>
-    #   <added><blank><removed><blank><file2>
-    #   ...
-    # Total up the stat lines for each commit and record them when we see the
-    # next commit. This causes a false record at index 0.
-    for line in res.stdout.splitlines():
-        if re.fullmatch(b"[a-f0-9]{40}", line):
-            added.append(a)
-            removed.append(r)
-            changed.append(c)
-            a = r = c = 0
-            continue
-
-        stat = line.split()
-        if len(stat) == 0:
-            continue
-
-        # Skip binary files
-        if stat[0] == b"-":
-            continue
-
-        a += int(stat[0])
-        r += int(stat[1])
-        c = a + r
+        cmd.extend(("--before", before))
+
+    # Packed machine integers rather than lists of boxed ints; large
+    # histories have millions of commits.
+    added = array.array("q")
+    removed = array.array("q")
+    changed = array.array("q")
+
+    # Collect Git's warnings in a file rather than a pipe: nothing reads
+    # stderr until stdout ends, and a full pipe would stall Git.
+    with tempfile.TemporaryFile() as errors:
+        # Parse the log as Git writes it instead of holding all of it in
+        # memory at once.
+        with subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=errors,
+                # Spare the child scanning for and closing every inherited file
+                # descriptor before it execs git.
+                close_fds=False,
+                # The stat line is translated; parse the untranslated one.
+                env=dict(os.environ, LC_ALL="C")) as proc:
+            # stdout format is
+            #   <commit>
+            #   <empty>
+            #   <blank><n> files changed, <a> insertions(+), <r> deletions(-)
+            # Commits without changes have no stat line, so record every
+            # commit as empty and fill in its stat line if one follows.
+            for line in proc.stdout:
+                if line.startswith(b" "):
+                    stat = _SHORTSTAT.match(line)
+                    a = int(stat.group(1) or 0)
+                    r = int(stat.group(2) or 0)
+                    added[-1] = a
+                    removed[-1] = r
+                    changed[-1] = a + r
+                # Lines read from the pipe keep their newline. Object names
+                # are 40 hex digits for SHA-1 and 64 for SHA-256.
+                elif (len(line) in (41, 65)
+                        and not line[:-1].translate(None, _HEX)):
+                    added.append(0)
+                    removed.append(0)
+                    changed.append(0)
+
+        errors.seek(0)
+        stderr = errors.read()
+
+    if proc.returncode:
+        raise subprocess.CalledProcessError(
+                proc.returncode,
+                cmd,
+                stderr=stderr)
 
     return pd.DataFrame({
-        "added": added[1:],
-        "removed": removed[1:],
-        "changed": changed[1:],
+        "added": np.frombuffer(added, dtype=np.int64),
+        "removed": np.frombuffer(removed, dtype=np.int64),
+        "changed": np.frombuffer(changed, dtype=np.int64),
         })
 
 
-# Adapted from https://stackoverflow.com/a/43455567/482758
+def cdf(sizes, max_size=None):
+    """
+    Computes the empirical cumulative distribution function of sizes
+    directly from the sorted values: the i'th smallest of n values has
+    probability i / n.
+    :param sizes: The commit sizes, in ascending order
+    :param max_size: Disregard sizes above this, if set
+    :return: The sizes and their cumulative probabilities
+    """
+    x = sizes
+    if max_size:
+        x = x[:np.searchsorted(x, max_size, side="right")]
+    p = np.arange(1, len(x) + 1) / len(x)
+
+    # Only the last of each run of equal sizes is a corner of the step, so
+    # drop the rest rather than drawing a vertex per commit.
+    corners = np.empty(len(x), dtype=bool)
+    corners[:-1] = x[1:] != x[:-1]
+    corners[-1:] = True
+    return x[corners], p[corners]
+
+
 def mark_hours(ax):
     """
-    Effeciently draws vertical lines at increments of 400,
+    Efficiently draws vertical lines at increments of 400,
     the middle optimal-inspection-rate, per
     https://www.ibm.com/developerworks/rational/library/11-proven-practices-for-peer-review/
     :param ax: The x axis
     """
     _, x_max = ax.get_xlim()
-    xs = np.array(range(400, int(x_max), 400), copy=False)
-    x_points = np.repeat(xs, repeats=3)
-    y_points = np.repeat(
-            np.array((0, 1.05, np.nan))[None, :],
-            repeats=len(xs),
-            axis=0).flatten()
-
-    plt.plot(
-            x_points,
-            y_points,
-            scaley=False,
+    ax.vlines(
+            np.arange(400, int(x_max), 400),
+            0,
+            1.05,
             color="black",
-            linewidth="0.5")
+            linewidth=0.5)
 
 
 def main(args):
@@ -144,24 +210,16 @@ def main(args):
             ylabel="Probability")
 
     ax.yaxis.set_ticks(np.arange(0, 1.1, 0.1))
+    ax.set_ylim(0, 1.05)
+
+    names = ("added", "removed", "changed")
+    # One contiguous row per series, all sorted in a single call.
+    sizes = np.vstack([df[name].values for name in names])
+    sizes.sort(axis=1)
 
-    x_range = None
-    if args.max_size:
-        # Although the range kwarg's documentation suggests it represents the
-        # "max size" it always uses the supplied value, inflating the x_max
-        # when the specified limit exceeds the max input. Compare the max input
-        # to prevent that.
-        x_range = (0, min(args.max_size, df.changed.max()))
-
-    ax.hist(
-            [df.added, df.removed, df.changed],
-            bins=len(df.changed),
-            normed=True,
-            histtype="step",
-            range=x_range,
-            color=("green", "red", "blue"),
-            cumulative=True,
-            label=("added", "removed", "changed"))
+    for name, color, row in zip(names, ("green", "red", "blue"), sizes):
+        x, p = cdf(row, args.max_size)
+        ax.step(x, p, where="post", color=color, label=name)
 
     ax.legend(loc="lower right").set_visible(True)
 